@@ -20,125 +20,164 @@ import paho.mqtt.client as mqtt
 import time
 import sys
 import ssl
-import random
+import threading
 import json
-import argparse
+import logging
+import re
 import hmac
 import hashlib
 import base64
+import functools
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import NamedTuple
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from urllib.parse import quote_plus
+from mqtt_socket import loop_until, tune_client_socket
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _dumps = orjson.dumps
+else:
+    def _dumps(obj):
+        """Serialize obj to compact JSON bytes (stdlib fallback when orjson is unavailable)."""
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+logger = logging.getLogger(__name__)
 
 # Connection Constants - Read from environment variables
 HUB_NAME = os.getenv("HUB_NAME", "ruath-iothub-004")
 DEVICE_NAME = os.getenv("DEVICE_NAME", "ruath-device-001")
 HOST = f"{HUB_NAME}.azure-devices-int.net"
 PORT = 8883
-CLIENT_ID = DEVICE_NAME
-USERNAME = f"{HOST}/{CLIENT_ID}/?api-version=2025-08-01-preview"
+API_VERSION = "2025-08-01-preview"
 CA_CERT = "../IoTHubRootCA.crt.pem"
 
-# X.509 Certificate Authentication - Use device name from environment
-DEVICE_CERT = f"./certGen/certs/{DEVICE_NAME}.crt"
-DEVICE_KEY = f"./certGen/private/{DEVICE_NAME}.key"
-
 # SAS Token Authentication
 HUB_SAS_KEY = "<Your Hub SAS Key Here>"
 HUB_SAS_POLICY = "iothubowner"
 
 MOCK_CSR = "TU9DSyBDU1I="
 
-# Global flag to track if response was received
-response_received = False
+# Log banners
+_BANNER = "=" * 70
+_BANNER_OPEN = "\n" + _BANNER
+_BANNER_CLOSE = _BANNER + "\n"
+_RULE = "-" * 70
 
-class MQTTTestScenario:
-    """Base class for MQTT test scenarios."""
-    
-    def __init__(self, name, description):
-        self.name = name
-        self.description = description
-        self.request_id = random.randint(1, 99999999)
-        self.subscribe_topic = "$iothub/credentials/res/#"
-        self.publish_topic = None
-        self.payload = None
-        self.disconnect_after_publish = False
-        self.reconnect_delay = 0
-    
-    def get_publish_topic(self):
-        """Return the topic to publish to."""
-        return self.publish_topic
-    
-    def get_payload(self):
-        """Return the payload to publish."""
-        return self.payload
-    
-    def validate_response(self, topic, payload):
-        """
-        Validate the response from the server.
-        Returns (success: bool, message: str)
-        """
-        return True, "Response received"
-
-class HappyPathScenario(MQTTTestScenario):
-    """Scenario: Issue certificate with valid CSR (happy path)."""
-    
-    def __init__(self):
-        super().__init__(
-            name="happy_path",
-            description="Issue a certificate with valid CSR"
-        )
-        self.publish_topic = f"$iothub/credentials/POST/issueCertificate/?$rid={self.request_id}"
-        self.payload = {
-            "id": CLIENT_ID,
-            "csr": MOCK_CSR
-        }
-    
-    def validate_response(self, topic, payload):
-        """Validate the response for happy path scenario."""
-        # Extract status code from topic
-        # Topic format: $iothub/credentials/res/202/?$rid=999888777&$version=1
-        parts = topic.split('/')
-        if len(parts) >= 4:
-            status_code = parts[3]
-            if status_code == "202":
-                return True, f"✓ SUCCESS: Received expected status code 202"
-            else:
-                return False, f"✗ FAILURE: Expected status code 202, got {status_code}"
-        return False, "✗ FAILURE: Could not parse status code from topic"
-
-class DisconnectReconnectScenario(MQTTTestScenario):
-    """Scenario: Disconnect after publishing request, then reconnect to receive response."""
-    
-    def __init__(self):
-        super().__init__(
-            name="disconnect_reconnect",
-            description="Disconnect after publish, reconnect later to receive response"
-        )
-        self.publish_topic = f"$iothub/credentials/POST/issueCertificate/?$rid={self.request_id}"
-        self.payload = {
-            "id": CLIENT_ID,
-            "csr": MOCK_CSR
-        }
-        self.disconnect_after_publish = True
-        self.reconnect_delay = 3  # seconds to wait before reconnecting
-    
-    def validate_response(self, topic, payload):
-        """Validate the response for disconnect/reconnect scenario."""
-        parts = topic.split('/')
-        if len(parts) >= 4:
-            status_code = parts[3]
-            if status_code == "202":
-                return True, f"✓ SUCCESS: Received response after reconnection (status code 202)"
-            else:
-                return False, f"✗ FAILURE: Expected status code 202, got {status_code}"
-        return False, "✗ FAILURE: Could not parse status code from topic"
+# Response topic format: $iothub/credentials/res/202/?$rid=999888777&$version=1
+_STATUS_RE = re.compile(r'\$iothub/credentials/res/(\d+)/')
+_RID_RE = re.compile(r'[?&]\$rid=(\d+)')
+
+# Print full response payloads (set by --verbose)
+VERBOSE = False
+
+SUBSCRIBE_TOPIC = "$iothub/credentials/res/#"
+
+# How long the hub keeps the MQTT session (subscriptions and undelivered
+# responses) after the client disconnects
+SESSION_EXPIRY_INTERVAL = 3600  # seconds
+
+def _emit(*lines):
+    """Write a block of output lines to stdout with a single write call."""
+    sys.stdout.write("\n".join(lines) + "\n")
+
+def _status_code(topic):
+    """Return the status code from a response topic, or None if it does not match."""
+    m = _STATUS_RE.match(topic)
+    return m.group(1) if m else None
+
+def _request_id(topic):
+    """Return the request ID from a response topic, or None if it has none."""
+    m = _RID_RE.search(topic)
+    return int(m.group(1)) if m else None
+
+class ScenarioSpec(NamedTuple):
+    """Static description of a test scenario."""
+    name: str
+    description: str
+    disconnect_after_publish: bool = False
+    reconnect_delay: int = 0  # seconds to wait before reconnecting
+
+class RunState(NamedTuple):
+    """Per-run request details shared by every scenario."""
+    request_id: int
+    publish_topic: str
+    payload_bytes: bytes
+
+def device_username(device):
+    """Return the MQTT username for a device."""
+    return f"{HOST}/{device}/?api-version={API_VERSION}"
+
+def device_cert_paths(device):
+    """Return the (certificate, private key) paths generated for a device by certGen."""
+    return f"./certGen/certs/{device}.crt", f"./certGen/private/{device}.key"
+
+def new_run_state(device=DEVICE_NAME):
+    """Build the request ID, publish topic and serialized payload for one run."""
+    request_id = int.from_bytes(os.urandom(4), 'little') % 99999999 + 1
+    return RunState(
+        request_id=request_id,
+        publish_topic=f"$iothub/credentials/POST/issueCertificate/?$rid={request_id}",
+        payload_bytes=_dumps({"id": device, "csr": MOCK_CSR})
+    )
+
+def validate_response(topic, payload):
+    """
+    Validate the response from the server.
+    Returns (success: bool, message: str)
+    """
+    status_code = _status_code(topic)
+    if status_code is not None:
+        if status_code == "202":
+            return True, f"✓ SUCCESS: Received expected status code 202"
+        else:
+            return False, f"✗ FAILURE: Expected status code 202, got {status_code}"
+    return False, "✗ FAILURE: Could not parse status code from topic"
 
 # Registry of available scenarios
 SCENARIOS = {
-    "happy_path": HappyPathScenario,
-    "disconnect_reconnect": DisconnectReconnectScenario,
+    "happy_path": ScenarioSpec(
+        "happy_path",
+        "Issue a certificate with valid CSR"
+    ),
+    "disconnect_reconnect": ScenarioSpec(
+        "disconnect_reconnect",
+        "Disconnect after publish, reconnect later to receive response",
+        disconnect_after_publish=True,
+        reconnect_delay=3
+    ),
 }
 
+@functools.lru_cache(maxsize=None)
+def _sas_hmac_prototype(key):
+    """
+    Return an HMAC-SHA256 object keyed with the decoded SAS key.
+    
+    The key is base64-decoded and absorbed into the HMAC state once; callers
+    copy() the returned object and only hash their own message.
+    """
+    # Decode the key from base64
+    try:
+        decoded_key = base64.b64decode(key)
+    except Exception as e:
+        print(f"✗ Error decoding key: {e}")
+        sys.exit(1)
+    
+    return hmac.new(decoded_key, b'', hashlib.sha256)
+
+@functools.lru_cache(maxsize=None)
+def _sas_token_template(uri, policy_name):
+    """Return the (prefix, suffix) surrounding the signature and expiry of a SAS token."""
+    prefix = f"SharedAccessSignature sr={uri}&sig="
+    suffix = f"&skn={policy_name}" if policy_name else ""
+    return prefix, suffix
+
 def generate_sas_token(uri, key, policy_name=None, expiry=3600):
     """
     Generate a SAS token for Azure IoT Hub authentication.
@@ -155,58 +194,64 @@ def generate_sas_token(uri, key, policy_name=None, expiry=3600):
     ttl = int(time.time() + expiry)
     sign_key = f"{uri}\n{ttl}"
     
-    # Decode the key from base64
-    try:
-        decoded_key = base64.b64decode(key)
-    except Exception as e:
-        print(f"✗ Error decoding key: {e}")
-        sys.exit(1)
-    
-    # Create signature
-    signature = hmac.new(
-        decoded_key,
-        sign_key.encode('utf-8'),
-        hashlib.sha256
-    ).digest()
+    # Create signature from the pre-keyed HMAC state
+    mac = _sas_hmac_prototype(key).copy()
+    mac.update(sign_key.encode('utf-8'))
+    signature = mac.digest()
     
     # Encode signature to base64 and URL-encode it
     signature_b64 = base64.b64encode(signature).decode('utf-8')
     signature_encoded = quote_plus(signature_b64)
     
     # Build SAS token
-    if policy_name:
-        token = f"SharedAccessSignature sr={uri}&sig={signature_encoded}&se={ttl}&skn={policy_name}"
-    else:
-        token = f"SharedAccessSignature sr={uri}&sig={signature_encoded}&se={ttl}"
+    prefix, suffix = _sas_token_template(uri, policy_name)
+    token = f"{prefix}{signature_encoded}&se={ttl}{suffix}"
     
     return token
 
-def setup_certificate_auth(client):
+@functools.lru_cache(maxsize=None)
+def _ssl_context(device=None):
+    """
+    Return the SSL context for a device, or the shared SAS context.
+    
+    The CA bundle (and, for certificate auth, the device certificate and key)
+    is parsed once per process; every client for the same device shares the
+    cached context.
+    
+    Args:
+        device: Device whose certificate and key to load for X.509 auth,
+                or None for SAS auth (no client certificate)
+    
+    Returns:
+        The cached ssl.SSLContext
+    """
+    ctx = ssl.create_default_context(cafile=CA_CERT)
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    if device is not None:
+        ctx.load_cert_chain(*device_cert_paths(device))
+    return ctx
+
+def setup_certificate_auth(client, device=DEVICE_NAME):
     """Configure MQTT client for X.509 certificate authentication."""
-    print("Using X.509 Certificate Authentication")
-    print(f"Certificate: {DEVICE_CERT}")
-    print(f"Private Key: {DEVICE_KEY}\n")
+    cert_path, key_path = device_cert_paths(device)
+    _emit("Using X.509 Certificate Authentication",
+          f"Certificate: {cert_path}",
+          f"Private Key: {key_path}\n")
     
     # Set username for X.509 authentication (no password needed)
-    client.username_pw_set(username=USERNAME)
+    client.username_pw_set(username=device_username(device))
     
     # Configure TLS with X.509 client certificate
-    client.tls_set(
-        ca_certs=CA_CERT,
-        certfile=DEVICE_CERT,
-        keyfile=DEVICE_KEY,
-        cert_reqs=ssl.CERT_REQUIRED,
-        tls_version=ssl.PROTOCOL_TLS
-    )
+    client.tls_set_context(_ssl_context(device))
 
-def setup_sas_auth(client):
+def setup_sas_auth(client, device=DEVICE_NAME):
     """Configure MQTT client for SAS token authentication using IoT Hub policy."""
     print("Using SAS Token Authentication (Hub Policy)")
     
     # Generate SAS token using hub-level policy
     resource_uri = HOST
-    print(f"Generating SAS token for hub: {resource_uri}")
-    print(f"Using policy: {HUB_SAS_POLICY}")
+    _emit(f"Generating SAS token for hub: {resource_uri}",
+          f"Using policy: {HUB_SAS_POLICY}")
     
     sas_token = generate_sas_token(
         uri=resource_uri,
@@ -215,52 +260,54 @@ def setup_sas_auth(client):
         expiry=3600  # 1 hour expiration
     )
     
-    print(f"✓ SAS token generated (expires in 3600 seconds)")
-    print(f"Token preview: {sas_token[:80]}...\n")
+    _emit(f"✓ SAS token generated (expires in 3600 seconds)",
+          f"Token preview: {sas_token[:80]}...\n")
     
     # Set username and password (SAS token)
-    client.username_pw_set(username=USERNAME, password=sas_token)
+    client.username_pw_set(username=device_username(device), password=sas_token)
     
     # Configure TLS (without client certificate)
-    client.tls_set(
-        ca_certs=CA_CERT,
-        cert_reqs=ssl.CERT_REQUIRED,
-        tls_version=ssl.PROTOCOL_TLS
-    )
+    client.tls_set_context(_ssl_context())
 
-def create_callbacks(scenario):
-    """Create callback functions for the MQTT client."""
-    global response_received
+def create_callbacks():
+    """
+    Create callback functions for the MQTT client.
+    
+    The callbacks keep no state of their own; userdata is the ScenarioRunner
+    that owns the client.
+    """
     
-    def on_connect(client, userdata, flags, rc):
+    def on_connect(client, userdata, flags, rc, properties=None):
         """Callback for when the client connects to the broker."""
         if rc == 0:
             print(f"✓ Connected successfully to {HOST}")
-            print(f"✓ Subscribing to: {scenario.subscribe_topic}")
-            client.subscribe(scenario.subscribe_topic, qos=1)
+            tune_client_socket(client)
+            # Resume the in-flight scenario after a reconnect, otherwise start the pending one
+            if userdata.spec is not None:
+                if flags.get('session present'):
+                    # The hub kept our subscription and will deliver the pending response
+                    print("✓ Session resumed, waiting for pending response")
+                else:
+                    userdata.subscribe()
+            else:
+                userdata.start_next()
         else:
             print(f"✗ Connection failed with code {rc}")
             sys.exit(1)
     
-    def on_subscribe(client, userdata, mid, granted_qos):
+    def on_subscribe(client, userdata, mid, granted_qos, properties=None):
         """Callback for when subscription is acknowledged."""
-        print(f"✓ Subscribed successfully (QoS: {granted_qos})")
-        
-        publish_topic = scenario.get_publish_topic()
-        payload = scenario.get_payload()
+        # MQTT 5 reports a ReasonCodes object per topic rather than a bare QoS
+        print(f"✓ Subscribed successfully ({', '.join(str(rc) for rc in granted_qos)})")
         
-        print(f"✓ Publishing to: {publish_topic}")
-        
-        # Serialize payload to JSON if it's a dict
-        if isinstance(payload, dict):
-            payload_json = json.dumps(payload)
-        else:
-            payload_json = payload if payload else ""
+        publish_topic = userdata.run_state.publish_topic
+        payload = userdata.run_state.payload_bytes
         
-        print(f"  Payload: {payload_json}")
+        _emit(f"✓ Publishing to: {publish_topic}",
+              f"  Payload: {payload.decode('utf-8')}")
         
-        # Now publish the request
-        result = client.publish(publish_topic, payload=payload_json, qos=1)
+        # Now publish the pre-serialized request
+        result = client.publish(publish_topic, payload=payload, qos=1)
         if result.rc == mqtt.MQTT_ERR_SUCCESS:
             print(f"✓ Publish request sent (mid: {result.mid})")
         else:
@@ -270,54 +317,61 @@ def create_callbacks(scenario):
         """Callback for when a message is published."""
         print(f"✓ Publish acknowledged by broker (mid: {mid})")
         
-        # If scenario requires disconnect after publish, unsubscribe and disconnect immediately
-        if scenario.disconnect_after_publish:
-            print(f"✓ Unsubscribing from: {scenario.subscribe_topic}")
-            client.unsubscribe(scenario.subscribe_topic)
-            print(f"\n{'='*70}")
-            print("DISCONNECTING after publish (as per scenario)")
-            print(f"{'='*70}\n")
+        # If scenario requires disconnect after publish, disconnect immediately.
+        # The subscription stays in the persistent session so the response is
+        # held by the hub until we reconnect.
+        if userdata.spec is not None and userdata.spec.disconnect_after_publish and not userdata.reconnected:
+            _emit(_BANNER_OPEN,
+                  "DISCONNECTING after publish (as per scenario)",
+                  _BANNER_CLOSE)
             # Disconnect immediately without waiting
             client.disconnect()
     
     def on_message(client, userdata, msg):
         """Callback for when a message is received."""
-        global response_received
-        print(f"\n{'='*70}")
-        print(f"✓ RESPONSE RECEIVED!")
-        print(f"{'='*70}")
-        print(f"Topic: {msg.topic}")
-        print(f"QoS: {msg.qos}")
-        print(f"Payload length: {len(msg.payload)} bytes")
+        # A persistent session can replay responses to requests from earlier runs
+        if userdata.spec is None or _request_id(msg.topic) != userdata.run_state.request_id:
+            print(f"Ignoring response for another request: {msg.topic}")
+            return
         
-        payload_str = ""
-        if msg.payload:
-            payload_str = msg.payload.decode('utf-8', errors='replace')
-            print(f"Payload: {payload_str}")
-        else:
-            print(f"Payload: (empty)")
+        # Collect the report and write it out in one go
+        lines = [
+            _BANNER_OPEN,
+            f"✓ RESPONSE RECEIVED!",
+            _BANNER,
+            f"Topic: {msg.topic}",
+            f"QoS: {msg.qos}",
+            f"Payload length: {len(msg.payload)} bytes",
+        ]
+        
+        # Only decode the payload when it is going to be printed
+        if VERBOSE:
+            if msg.payload:
+                lines.append(f"Payload: {msg.payload.decode('utf-8', errors='replace')}")
+            else:
+                lines.append(f"Payload: (empty)")
         
         # Extract status code from topic
-        parts = msg.topic.split('/')
-        if len(parts) >= 4:
-            status_code = parts[3]
-            print(f"\nStatus Code: {status_code}")
+        status_code = _status_code(msg.topic)
+        if status_code is not None:
+            lines.append(f"\nStatus Code: {status_code}")
         
-        # Validate response using scenario-specific validation
-        success, message = scenario.validate_response(msg.topic, payload_str)
-        print(f"\n{message}")
+        # Validate response
+        success, message = validate_response(msg.topic, msg.payload)
+        lines.append(f"\n{message}")
         
-        print(f"{'='*70}\n")
+        lines.append(_BANNER_CLOSE)
+        _emit(*lines)
         
-        response_received = True
-        client.disconnect()
+        userdata.finish(success)
     
-    def on_disconnect(client, userdata, rc):
+    def on_disconnect(client, userdata, rc, properties=None):
         """Callback for when the client disconnects."""
         if rc == 0:
             print("✓ Disconnected gracefully")
         else:
             print(f"✗ Unexpected disconnection (code: {rc})")
+        userdata.disconnect_event.set()
     
     def on_log(client, userdata, level, buf):
         """Callback for logging."""
@@ -325,157 +379,314 @@ def create_callbacks(scenario):
     
     return on_connect, on_subscribe, on_publish, on_message, on_disconnect, on_log
 
-def run_scenario(scenario_class, use_cert_auth):
-    """Run a specific test scenario."""
-    global response_received
-    response_received = False
-    
-    # Instantiate the scenario
-    scenario = scenario_class()
-    
-    print("\n" + "=" * 70)
-    print(f"MQTT Credential Management Test - {scenario.name}")
-    print(f"Description: {scenario.description}")
-    print("=" * 70)
+def _build_client(use_cert_auth, device=DEVICE_NAME):
+    """
+    Create the MQTT client used for every scenario run in this process.
     
-    # Create MQTT client
-    # For disconnect/reconnect scenarios, use clean_session=False to preserve subscriptions
-    # clean_session = not scenario.disconnect_after_publish
-    client = mqtt.Client(client_id=CLIENT_ID, clean_session=True, protocol=mqtt.MQTTv311)
+    Authentication and TLS are configured once here; ScenarioRunner only
+    wires up the callbacks.
+    """
+    # MQTT 5.0 so the session (and pending responses) can outlive a disconnect
+    client = mqtt.Client(client_id=device, protocol=mqtt.MQTTv5)
     
     # Configure authentication
     if use_cert_auth:
-        setup_certificate_auth(client)
+        setup_certificate_auth(client, device)
     else:
-        setup_sas_auth(client)
-    
-    # Set callbacks
-    on_connect, on_subscribe, on_publish, on_message, on_disconnect, on_log = create_callbacks(scenario)
-    client.on_connect = on_connect
-    client.on_subscribe = on_subscribe
-    client.on_publish = on_publish
-    client.on_message = on_message
-    client.on_disconnect = on_disconnect
-    # Uncomment for verbose logging:
-    # client.on_log = on_log
+        setup_sas_auth(client, device)
     
-    try:
-        # Connect to broker
-        print(f"\nConnecting to {HOST}:{PORT}...")
-        client.connect(HOST, PORT, keepalive=60)
+    return client
+
+class ScenarioRunner:
+    """
+    Run scenarios on one long-lived client.
+    
+    The client's network loop is driven on the calling thread, so socket I/O,
+    callbacks and the timeout all run on a single thread. run() sets the pending
+    scenario, which the connect callback (or run() itself, if already
+    connected) starts, then pumps the loop until its response arrives or the
+    timeout expires.
+    """
+    
+    def __init__(self, client, device=DEVICE_NAME, timeout=15):
+        self.client = client
+        self.device = device
+        self.timeout = timeout  # seconds
+        self.spec = None
+        self.run_state = None
+        self.reconnected = False
+        self.success = False
+        self.response_event = threading.Event()
+        self.disconnect_event = threading.Event()
+        self._pending = None
+        
+        # Set callbacks; they reach this runner through userdata
+        client.user_data_set(self)
+        on_connect, on_subscribe, on_publish, on_message, on_disconnect, on_log = create_callbacks()
+        client.on_connect = on_connect
+        client.on_subscribe = on_subscribe
+        client.on_publish = on_publish
+        client.on_message = on_message
+        client.on_disconnect = on_disconnect
+        # Uncomment for verbose logging:
+        # client.on_log = on_log
+    
+    def subscribe(self):
+        """Subscribe for responses; the SUBACK callback publishes the current request."""
+        print(f"✓ Subscribing to: {SUBSCRIBE_TOPIC}")
+        self.client.subscribe(SUBSCRIBE_TOPIC, qos=1)
+    
+    def start_next(self):
+        """Start the pending scenario, if any."""
+        spec, self._pending = self._pending, None
+        if spec is None:
+            return
+        self.run_state = new_run_state(self.device)
+        self.reconnected = False
+        self.spec = spec
+        self.subscribe()
+    
+    def finish(self, success):
+        """Mark the current scenario as complete."""
+        self.spec = None
+        self.success = success
+        self.response_event.set()
+    
+    def run(self, spec):
+        """
+        Run one scenario and wait for its response.
+        
+        Returns True if a response arrived and passed validation.
+        """
+        self.success = False
+        self.response_event.clear()
+        self.disconnect_event.clear()
+        
+        _emit(_BANNER_OPEN,
+              f"MQTT Credential Management Test - {spec.name}",
+              f"Description: {spec.description}",
+              _BANNER)
         
-        # Start the loop
-        client.loop_start()
+        self._pending = spec
+        
+        if self.client.is_connected():
+            self.start_next()
+        else:
+            # Connect to broker
+            print(f"\nConnecting to {HOST}:{PORT}...")
+            connect_props = Properties(PacketTypes.CONNECT)
+            connect_props.SessionExpiryInterval = SESSION_EXPIRY_INTERVAL
+            self.client.connect(HOST, PORT, keepalive=60, clean_start=False, properties=connect_props)
         
         # Wait for response or timeout (or for disconnect in disconnect scenarios)
-        timeout = 15  # seconds
-        start_time = time.time()
+        deadline = time.monotonic() + self.timeout
         
         # For disconnect/reconnect scenarios, wait for disconnect first
-        if scenario.disconnect_after_publish:
+        if spec.disconnect_after_publish:
             print(f"Waiting for disconnect after publish...")
-            while client.is_connected() and (time.time() - start_time) < timeout:
-                time.sleep(0.1)
-            
-            if not client.is_connected():
-                print(f"\n✓ Client disconnected as expected")
-                print(f"Waiting {scenario.reconnect_delay} seconds before reconnecting...")
-                time.sleep(scenario.reconnect_delay)
+            if loop_until(self.client, self.disconnect_event, deadline):
+                _emit(f"\n✓ Client disconnected as expected",
+                      f"Waiting {spec.reconnect_delay} seconds before reconnecting...")
+                time.sleep(spec.reconnect_delay)
                 
                 # Reconnect
-                print(f"\n{'='*70}")
-                print("RECONNECTING to check for pending response")
-                print(f"{'='*70}\n")
-                print(f"Connecting to {HOST}:{PORT}...")
-                client.connect(HOST, PORT, keepalive=60)
+                _emit(_BANNER_OPEN,
+                      "RECONNECTING to check for pending response",
+                      _BANNER_CLOSE,
+                      f"Connecting to {HOST}:{PORT}...")
+                self.disconnect_event.clear()
+                self.reconnected = True
+                # Reuse the same client so the hub resumes the persistent MQTT session
+                self.client.reconnect()
                 
                 # Reset timeout for second connection
-                start_time = time.time()
+                deadline = time.monotonic() + self.timeout
         
         # Wait for response
-        while not response_received and (time.time() - start_time) < timeout:
-            time.sleep(0.1)
-        
-        if not response_received:
-            print(f"\n✗ Timeout: No response received after {timeout} seconds")
-            client.disconnect()
-        
-        # Give a moment for disconnect to complete
-        time.sleep(0.5)
-        client.loop_stop()
+        if not loop_until(self.client, self.response_event, deadline):
+            if time.monotonic() < deadline:
+                print(f"\n✗ Connection lost before a response was received")
+            else:
+                print(f"\n✗ Timeout: No response received after {self.timeout} seconds")
+            self.spec = None
+            return False
+        return self.success
+    
+    def close(self):
+        """Disconnect from the broker."""
+        if self.client.is_connected():
+            self.disconnect_event.clear()
+            self.client.disconnect()
+            # Keep the loop running until DISCONNECT has been sent
+            loop_until(self.client, self.disconnect_event, time.monotonic() + 1)
+
+def run_scenario(client, spec, device=DEVICE_NAME):
+    """
+    Run a specific test scenario on an already configured client.
+    
+    Returns True if a response arrived and passed validation.
+    """
+    runner = ScenarioRunner(client, device)
+    
+    try:
+        success = runner.run(spec)
+        runner.close()
+        return success
         
     except KeyboardInterrupt:
         print("\n✗ Interrupted by user")
-        client.disconnect()
-        client.loop_stop()
+        runner.close()
+        return False
     except Exception as e:
-        print(f"\n✗ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("✗ Error: %s", e)
         sys.exit(1)
 
+def run_many(device_names, spec, use_cert_auth):
+    """
+    Run a scenario for several devices in parallel, one client per device.
+    
+    The TLS contexts, SAS signing key and compiled patterns are shared by all
+    worker threads; each thread owns and drives its own client.
+    
+    Returns True if every device received a successful response.
+    """
+    def run_device(device):
+        client = _build_client(use_cert_auth, device)
+        runner = ScenarioRunner(client, device)
+        try:
+            return runner.run(spec)
+        finally:
+            runner.close()
+    
+    results = []
+    with ThreadPoolExecutor(max_workers=min(32, len(device_names))) as executor:
+        futures = {executor.submit(run_device, device): device for device in device_names}
+        for future in as_completed(futures):
+            device = futures[future]
+            try:
+                ok = future.result()
+            except (Exception, SystemExit) as e:
+                logger.exception("✗ Error for device %s: %s", device, e)
+                ok = False
+            print(f"{'✓' if ok else '✗'} {device}: {'passed' if ok else 'failed'}")
+            results.append(ok)
+    
+    _emit(_BANNER_OPEN,
+          f"Sweep complete: {sum(results)}/{len(results)} devices passed",
+          _BANNER_CLOSE)
+    return all(results)
+
+def read_device_names(path):
+    """Read device names from a file, one per line; blank lines and # comments are skipped."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
 def list_scenarios():
     """Print available scenarios."""
-    print("\nAvailable Scenarios:")
-    print("-" * 70)
-    for name, scenario_class in SCENARIOS.items():
-        scenario = scenario_class()
-        print(f"  {name:20} - {scenario.description}")
-    print("-" * 70)
+    _emit("\nAvailable Scenarios:",
+          _RULE,
+          *(f"  {name:20} - {spec.description}" for name, spec in SCENARIOS.items()),
+          _RULE)
+
+HELP = """\
+usage: mqtt_credential_test.py [scenario] (--cert | --sas) [--verbose] [--sweep DEVICES_FILE]
+       mqtt_credential_test.py --list-scenarios
+
+MQTT Credential Management Test Script - Scenario Based
+
+positional arguments:
+  scenario              Scenario to run (default: happy_path)
+
+options:
+  -h, --help            Show this help message and exit
+  --list-scenarios      List all available scenarios
+  --verbose             Print full response payloads
+  --sweep DEVICES_FILE  Run the scenario in parallel for every device listed in the file
+  --cert                Use X.509 certificate authentication
+  --sas                 Use SAS token authentication (token will be generated)
 
-def main():
-    # Parse command-line arguments
-    parser = argparse.ArgumentParser(
-        description='MQTT Credential Management Test Script - Scenario Based',
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="""
 Scenarios:
   happy_path            Issue a certificate with valid CSR
   disconnect_reconnect  Disconnect after publish, reconnect to receive response
-  
-Authentication Methods:
-  --cert    Use X.509 certificate authentication
-  --sas     Use SAS token authentication (token will be generated)
-  
+
 Examples:
   python mqtt_credential_test.py happy_path --cert
   python mqtt_credential_test.py happy_path --sas
   python mqtt_credential_test.py disconnect_reconnect --cert
+  python mqtt_credential_test.py happy_path --cert --verbose
+  python mqtt_credential_test.py happy_path --cert --sweep devices.txt
   python mqtt_credential_test.py --list-scenarios
-        """
-    )
-    
-    parser.add_argument('scenario', nargs='?', default='happy_path',
-                       help='Scenario to run (default: happy_path)')
-    parser.add_argument('--list-scenarios', action='store_true',
-                       help='List all available scenarios')
-    
-    auth_group = parser.add_mutually_exclusive_group(required=False)
-    auth_group.add_argument('--cert', action='store_true',
-                           help='Use X.509 certificate authentication')
-    auth_group.add_argument('--sas', action='store_true',
-                           help='Use SAS token authentication')
-    
-    args = parser.parse_args()
+"""
+
+def _usage_error(message):
+    """Report a command-line error the way argparse would and exit with status 2."""
+    sys.stderr.write(f"{HELP.splitlines()[0]}\nmqtt_credential_test.py: error: {message}\n")
+    sys.exit(2)
+
+def main():
+    global VERBOSE
+    
+    # Parse command-line arguments by hand; the surface is small and this
+    # keeps argparse (and its gettext/textwrap imports) off the startup path
+    scenario = None
+    sweep = None
+    use_cert = use_sas = show_scenarios = False
+    argv = iter(sys.argv[1:])
+    for arg in argv:
+        if arg in ('-h', '--help'):
+            print(HELP, end='')
+            return
+        elif arg == '--list-scenarios':
+            show_scenarios = True
+        elif arg == '--verbose':
+            VERBOSE = True
+        elif arg == '--cert':
+            use_cert = True
+        elif arg == '--sas':
+            use_sas = True
+        elif arg == '--sweep' or arg.startswith('--sweep='):
+            _, has_value, sweep = arg.partition('=')
+            if not has_value:
+                sweep = next(argv, None)
+            if not sweep or sweep.startswith('-'):
+                _usage_error("argument --sweep: expected one argument")
+        elif arg.startswith('-'):
+            _usage_error(f"unrecognized arguments: {arg}")
+        elif scenario is None:
+            scenario = arg
+        else:
+            _usage_error(f"unrecognized arguments: {arg}")
     
     # List scenarios if requested
-    if args.list_scenarios:
+    if show_scenarios:
         list_scenarios()
         return
     
-    # Validate authentication method is specified
-    if not args.cert and not args.sas:
-        parser.error("Authentication method required: use --cert or --sas")
+    # Validate exactly one authentication method is specified
+    if use_cert and use_sas:
+        _usage_error("argument --sas: not allowed with argument --cert")
+    if not use_cert and not use_sas:
+        _usage_error("Authentication method required: use --cert or --sas")
     
     # Validate scenario exists
-    if args.scenario not in SCENARIOS:
-        print(f"✗ Error: Unknown scenario '{args.scenario}'")
+    scenario = scenario or 'happy_path'
+    if scenario not in SCENARIOS:
+        print(f"✗ Error: Unknown scenario '{scenario}'")
         list_scenarios()
         sys.exit(1)
     
     # Run the scenario
-    scenario_class = SCENARIOS[args.scenario]
-    run_scenario(scenario_class, use_cert_auth=args.cert)
+    spec = SCENARIOS[scenario]
+    
+    if sweep:
+        device_names = read_device_names(sweep)
+        if not device_names:
+            print(f"✗ Error: No device names found in '{sweep}'")
+            sys.exit(1)
+        sys.exit(0 if run_many(device_names, spec, use_cert_auth=use_cert) else 1)
+    
+    client = _build_client(use_cert_auth=use_cert)
+    sys.exit(0 if run_scenario(client, spec) else 1)
 
 if __name__ == "__main__":
     main()
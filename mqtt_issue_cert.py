@@ -13,28 +13,69 @@ import paho.mqtt.client as mqtt
 import time
 import sys
 import ssl
-import random
+import threading
+import os
 import json
+import logging
 import argparse
+import re
 import io
+from importlib.metadata import PackageNotFoundError, version as _pkg_ver
+from mqtt_socket import loop_until, tune_client_socket
 
-# Check paho-mqtt version for API compatibility
-PAHO_MQTT_VERSION = getattr(mqtt, '__version__', '1.0.0')
+logger = logging.getLogger(__name__)
+
+# Check paho-mqtt version once for API compatibility
+try:
+    PAHO_MQTT_VERSION = _pkg_ver("paho-mqtt")
+except PackageNotFoundError:
+    # No package metadata (e.g. a vendored copy); fall back to the module attribute
+    PAHO_MQTT_VERSION = getattr(mqtt, '__version__', '1.0.0')
 try:
-    major_version = int(PAHO_MQTT_VERSION.split('.')[0])
-    USE_NEW_CALLBACK_API = major_version >= 2
+    _PAHO_MAJOR = int(PAHO_MQTT_VERSION.split('.')[0])
 except (ValueError, IndexError):
-    USE_NEW_CALLBACK_API = False
+    _PAHO_MAJOR = 1
+
+if _PAHO_MAJOR >= 2:
+    def _make_client(client_id, userdata):
+        """Create an MQTT client using the paho-mqtt 2.x API."""
+        return mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION1,
+            client_id=client_id,
+            clean_session=True,
+            protocol=mqtt.MQTTv311,
+            userdata=userdata
+        )
+else:
+    def _make_client(client_id, userdata):
+        """Create an MQTT client using the paho-mqtt 1.x API."""
+        return mqtt.Client(
+            client_id=client_id,
+            clean_session=True,
+            protocol=mqtt.MQTTv311,
+            userdata=userdata
+        )
+
+# Log banners
+_BANNER = "=" * 70
+_BANNER_OPEN = "\n" + _BANNER
+_BANNER_CLOSE = _BANNER + "\n"
+
+# Response topic format: $iothub/credentials/res/202/?$rid=999888777&$version=1
+_STATUS_RE = re.compile(r'\$iothub/credentials/res/(\d+)/')
 
-# Global variables
-response_received = False
-response_data = None
-first_202_time = None
+# Print the payloads of intermediate responses too (set by --verbose)
+VERBOSE = False
+
+def _emit(*lines):
+    """Write a block of output lines to stdout with a single write call."""
+    sys.stdout.write("\n".join(lines) + "\n")
 
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the broker."""
     if rc == 0:
         print(f"[OK] Connected successfully to {userdata['host']}")
+        tune_client_socket(client)
         print(f"[OK] Subscribing to: {userdata['subscribe_topic']}")
         client.subscribe(userdata['subscribe_topic'], qos=1)
     else:
@@ -63,8 +104,8 @@ def on_subscribe(client, userdata, mid, granted_qos):
     publish_topic = userdata['publish_topic']
     payload = userdata['payload']
     
-    print(f"[OK] Publishing to: {publish_topic}")
-    print(f"  Payload: {payload}")
+    _emit(f"[OK] Publishing to: {publish_topic}",
+          f"  Payload: {payload}")
     
     result = client.publish(publish_topic, payload=payload, qos=1)
     if result.rc == mqtt.MQTT_ERR_SUCCESS:
@@ -78,54 +119,56 @@ def on_publish(client, userdata, mid):
 
 def on_message(client, userdata, msg):
     """Callback for when a message is received."""
-    global response_received, response_data, first_202_time
+    # Collect the report and write it out in one go
+    lines = [
+        _BANNER_OPEN,
+        f"[OK] RESPONSE RECEIVED!",
+        _BANNER,
+        f"Topic: {msg.topic}",
+        f"QoS: {msg.qos}",
+        f"Payload length: {len(msg.payload)} bytes",
+    ]
     
-    print(f"\n{'='*70}")
-    print(f"[OK] RESPONSE RECEIVED!")
-    print(f"{'='*70}")
-    print(f"Topic: {msg.topic}")
-    print(f"QoS: {msg.qos}")
-    print(f"Payload length: {len(msg.payload)} bytes")
+    # Extract status code from topic
+    m = _STATUS_RE.match(msg.topic)
+    status_code = m.group(1) if m else None
     
-    payload_str = ""
-    if msg.payload:
-        payload_str = msg.payload.decode('utf-8', errors='replace')
-        print(f"Payload: {payload_str}")
-    else:
-        print(f"Payload: (empty)")
+    # The 200 payload is the issued certificate, so it is always shown;
+    # intermediate responses are only dumped with --verbose
+    if VERBOSE or status_code == "200":
+        if msg.payload:
+            lines.append(f"Payload: {msg.payload.decode('utf-8', errors='replace')}")
+        else:
+            lines.append(f"Payload: (empty)")
     
-    # Extract status code from topic
-    # Topic format: $iothub/credentials/res/202/?$rid=999888777&$version=1
-    parts = msg.topic.split('/')
-    status_code = None
-    if len(parts) >= 4:
-        status_code = parts[3]
-        print(f"\nStatus Code: {status_code}")
+    if status_code is not None:
+        lines.append(f"\nStatus Code: {status_code}")
     
     # Validate response
     if status_code == "200":
-        print(f"\n[OK] SUCCESS: Received status code 200 - Certificate issued successfully")
-        if first_202_time is not None:
-            elapsed = time.time() - first_202_time
-            print(f"[INFO] Time between 202 and 200 response: {elapsed:.2f} seconds")
+        lines.append(f"\n[OK] SUCCESS: Received status code 200 - Certificate issued successfully")
+        if userdata['first_202_time'] is not None:
+            elapsed = time.monotonic() - userdata['first_202_time']
+            lines.append(f"[INFO] Time between 202 and 200 response: {elapsed:.2f} seconds")
     elif status_code == "202":
-        if first_202_time is None:
-            first_202_time = time.time()
-        print(f"\n[INFO] Received status code 202 - Request accepted, waiting for completion...")
+        if userdata['first_202_time'] is None:
+            userdata['first_202_time'] = time.monotonic()
+        lines.append(f"\n[INFO] Received status code 202 - Request accepted, waiting for completion...")
     else:
-        print(f"\n[WARN] WARNING: Received status code {status_code}")
+        lines.append(f"\n[WARN] WARNING: Received status code {status_code}")
     
-    print(f"{'='*70}\n")
+    lines.append(_BANNER_CLOSE)
+    _emit(*lines)
     
-    response_data = {
+    userdata['response_data'] = {
         'topic': msg.topic,
-        'payload': payload_str,
+        'payload': msg.payload,
         'status_code': status_code
     }
     
     # Only mark as complete and disconnect when we receive a 200 status
     if status_code == "200":
-        response_received = True
+        userdata['response_event'].set()
         client.disconnect()
 
 def on_disconnect(client, userdata, rc):
@@ -134,9 +177,10 @@ def on_disconnect(client, userdata, rc):
         print("[OK] Disconnected gracefully")
     else:
         print(f"[WARN] Unexpected disconnection (code: {rc})")
+    userdata['disconnect_event'].set()
 
 def main():
-    global response_received
+    global VERBOSE
     
     parser = argparse.ArgumentParser(
         description='Simple MQTT Certificate Issuance Script',
@@ -152,11 +196,13 @@ def main():
     parser.add_argument('--timeout', type=int, default=60, help='Response timeout in seconds (default: 60)')
     parser.add_argument('--api-version', default='2025-08-01-preview', help='API version (default: 2025-08-01-preview)')
     parser.add_argument('--csr', default='TU9DSyBDU1I=', help='Base64 encoded CSR (default: mock CSR)')
+    parser.add_argument('--verbose', action='store_true', help='Also print the payloads of intermediate (non-200) responses')
     
     args = parser.parse_args()
+    VERBOSE = args.verbose
     
     # Generate request ID
-    request_id = random.randint(1, 99999999)
+    request_id = int.from_bytes(os.urandom(4), 'little') % 99999999 + 1
     
     # MQTT configuration
     subscribe_topic = "$iothub/credentials/res/#"
@@ -164,58 +210,36 @@ def main():
     username = f"{args.host}/{args.device}/?api-version={args.api_version}"
     payload = json.dumps({"id": args.device, "csr": args.csr})
     
-    # User data to pass to callbacks
+    # User data to pass to callbacks; the callbacks also record the response state here
     userdata = {
         'host': args.host,
         'subscribe_topic': subscribe_topic,
         'publish_topic': publish_topic,
-        'payload': payload
+        'payload': payload,
+        'response_event': threading.Event(),
+        'disconnect_event': threading.Event(),
+        'response_data': None,
+        'first_202_time': None
     }
     
-    print("\n" + "=" * 70)
-    print("MQTT Certificate Issuance Request")
-    print("=" * 70)
-    print(f"Host: {args.host}")
-    print(f"Port: {args.port}")
-    print(f"Device: {args.device}")
-    print(f"Request ID: {request_id}")
-    print(f"CA Cert: {args.ca_cert}")
-    print(f"Device Cert: {args.device_cert}")
-    print(f"Device Key: {args.device_key}")
-    print(f"Subscribe Topic: {subscribe_topic}")
-    print(f"Publish Topic: {publish_topic}")
-    print("=" * 70 + "\n")
+    _emit(_BANNER_OPEN,
+          "MQTT Certificate Issuance Request",
+          _BANNER,
+          f"Host: {args.host}",
+          f"Port: {args.port}",
+          f"Device: {args.device}",
+          f"Request ID: {request_id}",
+          f"CA Cert: {args.ca_cert}",
+          f"Device Cert: {args.device_cert}",
+          f"Device Key: {args.device_key}",
+          f"Subscribe Topic: {subscribe_topic}",
+          f"Publish Topic: {publish_topic}",
+          _BANNER_CLOSE)
     
     # Create MQTT client - handle both old (1.x) and new (2.x) paho-mqtt API
     print(f"Using paho-mqtt version: {PAHO_MQTT_VERSION}")
     
-    try:
-        if USE_NEW_CALLBACK_API:
-            # paho-mqtt 2.0+ API
-            client = mqtt.Client(
-                callback_api_version=mqtt.CallbackAPIVersion.VERSION1,
-                client_id=args.device,
-                clean_session=True,
-                protocol=mqtt.MQTTv311,
-                userdata=userdata
-            )
-        else:
-            # paho-mqtt 1.x API
-            client = mqtt.Client(
-                client_id=args.device,
-                clean_session=True,
-                protocol=mqtt.MQTTv311,
-                userdata=userdata
-            )
-    except TypeError as e:
-        # Fallback: try without callback_api_version
-        print(f"[WARN] Client creation with callback_api_version failed, trying fallback: {e}")
-        client = mqtt.Client(
-            client_id=args.device,
-            clean_session=True,
-            protocol=mqtt.MQTTv311,
-            userdata=userdata
-        )
+    client = _make_client(args.device, userdata)
     
     # Set username
     client.username_pw_set(username=username)
@@ -241,24 +265,22 @@ def main():
         print(f"Connecting to {args.host}:{args.port}...")
         client.connect(args.host, args.port, keepalive=60)
         
-        # Start the loop
-        client.loop_start()
-        
-        # Wait for response or timeout
-        start_time = time.time()
-        while not response_received and (time.time() - start_time) < args.timeout:
-            time.sleep(0.1)
-        
-        if not response_received:
-            print(f"\n[FAIL] Timeout: No 200 response received after {args.timeout} seconds")
-            client.disconnect()
+        # Drive the network loop on this thread until the 200 response or timeout
+        deadline = time.monotonic() + args.timeout
+        if not loop_until(client, userdata['response_event'], deadline):
+            if time.monotonic() < deadline:
+                print(f"\n[FAIL] Connection lost before a 200 response was received")
+            else:
+                print(f"\n[FAIL] Timeout: No 200 response received after {args.timeout} seconds")
+                client.disconnect()
+                loop_until(client, userdata['disconnect_event'], time.monotonic() + 1)
             sys.exit(1)
         
-        # Give a moment for disconnect to complete
-        time.sleep(0.5)
-        client.loop_stop()
+        # Keep the loop running until DISCONNECT has been sent
+        loop_until(client, userdata['disconnect_event'], time.monotonic() + 1)
         
         # Exit with appropriate code (success if we received 200)
+        response_data = userdata['response_data']
         if response_data and response_data.get('status_code') == '200':
             sys.exit(0)
         else:
@@ -267,12 +289,10 @@ def main():
     except KeyboardInterrupt:
         print("\n[FAIL] Interrupted by user")
         client.disconnect()
-        client.loop_stop()
+        loop_until(client, userdata['disconnect_event'], time.monotonic() + 1)
         sys.exit(1)
     except Exception as e:
-        print(f"\n[FAIL] Error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[FAIL] Error: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
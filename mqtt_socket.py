@@ -0,0 +1,50 @@
+"""
+Socket tuning and network loop helpers shared by the MQTT scripts.
+"""
+import socket
+import time
+
+import paho.mqtt.client as mqtt
+
+# Send/receive buffer size for the MQTT connection
+SOCKET_BUFFER_SIZE = 65536  # bytes
+
+def tune_client_socket(client):
+    """
+    Tune the socket of a connected paho client.
+
+    Disables Nagle so small MQTT control packets (SUBSCRIBE, the publish
+    request) go out immediately, and sizes the send/receive buffers.
+    Does nothing if the client has no socket.
+    """
+    sock = client.socket()
+    if sock is None:
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+def loop_until(client, event, deadline):
+    """
+    Drive the client's network loop on the calling thread until event is set
+    or the deadline (a time.monotonic() value) passes.
+
+    Each client.loop() call blocks in select() until the socket is ready
+    (or at most one second, so keepalives keep running), so a callback
+    setting the event is seen as soon as it returns.
+
+    Stops early once the connection is gone: after an unexpected drop
+    paho returns MQTT_ERR_CONN_LOST immediately on every call instead of
+    blocking, so looping on would only spin until the deadline.
+
+    Returns True if the event was set.
+    """
+    while not event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        rc = client.loop(timeout=min(remaining, 1.0))
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            # Nothing left to drive; on_disconnect has already run
+            break
+    return event.is_set()